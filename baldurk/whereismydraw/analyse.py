@@ -25,12 +25,17 @@
 import qrenderdoc as qrd
 import renderdoc as rd
 import struct
+import itertools
 import math
+import operator
 import random
-from typing import Callable, Tuple, List
+from collections import namedtuple, OrderedDict
+from typing import Tuple, List
 
 
 class PixelHistoryData:
+    __slots__ = ('x', 'y', 'id', 'tex_display', 'history', 'view', 'last_eid')
+
     def __init__(self):
         self.x = 0
         self.y = 0
@@ -42,11 +47,19 @@ class PixelHistoryData:
 
 
 class ResultStep:
-    def __init__(self, *, msg='', tex_display=rd.TextureDisplay(), pixel_history=PixelHistoryData(),
+    __slots__ = ('msg', 'tex_display', 'pixel_history', 'pipe_stage', 'mesh_view')
+
+    empty_tex_display = rd.TextureDisplay()
+
+    def __init__(self, *, msg='', tex_display=None, pixel_history=PixelHistoryData(),
                  pipe_stage=qrd.PipelineStage.ComputeShader, mesh_view=rd.MeshDataStage.Count):
         self.msg = msg
-        # force copy the input, so it can be modified without changing the one in this step
-        self.tex_display = rd.TextureDisplay(tex_display)
+        # force copy the input, so it can be modified without changing the one in this step. Most steps have no
+        # texture to display and are only read from, so they can all share one empty display without copying.
+        if tex_display is None:
+            self.tex_display = ResultStep.empty_tex_display
+        else:
+            self.tex_display = rd.TextureDisplay(tex_display)
         self.pixel_history = pixel_history
         self.pipe_stage = pipe_stage
         self.mesh_view = mesh_view
@@ -62,6 +75,249 @@ class AnalysisFinished(Exception):
     pass
 
 
+# API-agnostic snapshots of the state the checks need, fetched once per analysis
+CullState = namedtuple('CullState', ['cull_mode', 'front_ccw'])
+DepthState = namedtuple('DepthState', ['enabled', 'func', 'bounds', 'clamp', 'ndc_bounds'])
+StencilState = namedtuple('StencilState', ['enabled', 'front', 'back'])
+StencilFaceState = namedtuple('StencilFaceState', ['function', 'reference', 'compareMask'])
+
+
+# API-specific state is fetched through these tables, keyed by the API, so the snapshots above can be built without
+# switching on the API each time. Each accessor is passed the API-specific pipeline state.
+
+# Fetches the API-specific pipeline state from the replay controller
+api_pipe_getters = {
+    rd.GraphicsAPI.OpenGL: lambda r: r.GetGLPipelineState(),
+    rd.GraphicsAPI.Vulkan: lambda r: r.GetVulkanPipelineState(),
+    rd.GraphicsAPI.D3D11: lambda r: r.GetD3D11PipelineState(),
+    rd.GraphicsAPI.D3D12: lambda r: r.GetD3D12PipelineState(),
+}
+
+# Returns the cull mode and whether front faces are counter-clockwise
+cull_state_getters = {
+    rd.GraphicsAPI.OpenGL: lambda pipe: (pipe.rasterizer.state.cullMode, pipe.rasterizer.state.frontCCW),
+    rd.GraphicsAPI.Vulkan: lambda pipe: (pipe.rasterizer.cullMode, pipe.rasterizer.frontCCW),
+    rd.GraphicsAPI.D3D11: lambda pipe: (pipe.rasterizer.state.cullMode, pipe.rasterizer.state.frontCCW),
+    rd.GraphicsAPI.D3D12: lambda pipe: (pipe.rasterizer.state.cullMode, pipe.rasterizer.state.frontCCW),
+}
+
+
+def default_cull_state(pipe):
+    return rd.CullMode.NoCull, False
+
+
+# Returns whether rasterizer discard is enabled, or None if the API has no such state
+raster_discard_getters = {
+    rd.GraphicsAPI.OpenGL: lambda pipe: pipe.vertexProcessing.discard,
+    rd.GraphicsAPI.Vulkan: lambda pipe: pipe.rasterizer.rasterizerDiscardEnable,
+}
+
+
+def default_raster_discard(pipe):
+    return None
+
+
+# The depth state getters return whether depth testing is enabled, the depth function, the depth bounds (or an empty
+# list if depth bounds testing is disabled), whether depth clamping is enabled, and the NDC z range
+def gl_depth_state(pipe: rd.GLState):
+    depth_bounds = []
+    if pipe.depthState.depthBounds:
+        depth_bounds = [pipe.depthState.nearBound, pipe.depthState.farBound]
+    ndc_bounds = [-1.0, 1.0] if pipe.vertexProcessing.clipNegativeOneToOne else [0.0, 1.0]
+    return (pipe.depthState.depthEnable, pipe.depthState.depthFunction, depth_bounds,
+            pipe.rasterizer.state.depthClamp, ndc_bounds)
+
+
+def vk_depth_state(pipe: rd.VKState):
+    depth_bounds = []
+    if pipe.depthStencil.depthBoundsEnable:
+        depth_bounds = [pipe.depthStencil.minDepthBounds, pipe.depthStencil.maxDepthBounds]
+    return (pipe.depthStencil.depthTestEnable, pipe.depthStencil.depthFunction, depth_bounds,
+            pipe.rasterizer.depthClampEnable, [0.0, 1.0])
+
+
+def d3d11_depth_state(pipe: rd.D3D11State):
+    ds = pipe.outputMerger.depthStencilState
+    return ds.depthEnable, ds.depthFunction, [], not pipe.rasterizer.state.depthClip, [0.0, 1.0]
+
+
+def d3d12_depth_state(pipe: rd.D3D12State):
+    ds = pipe.outputMerger.depthStencilState
+    depth_bounds = []
+    if ds.depthBoundsEnable:
+        depth_bounds = [ds.minDepthBounds, ds.maxDepthBounds]
+    return ds.depthEnable, ds.depthFunction, depth_bounds, not pipe.rasterizer.state.depthClip, [0.0, 1.0]
+
+
+def default_depth_state(pipe):
+    return False, rd.CompareFunction.AlwaysTrue, [], True, [0.0, 1.0]
+
+
+depth_state_getters = {
+    rd.GraphicsAPI.OpenGL: gl_depth_state,
+    rd.GraphicsAPI.Vulkan: vk_depth_state,
+    rd.GraphicsAPI.D3D11: d3d11_depth_state,
+    rd.GraphicsAPI.D3D12: d3d12_depth_state,
+}
+
+
+# Returns whether stencil testing is enabled, and the front and back face stencil state
+stencil_state_getters = {
+    rd.GraphicsAPI.OpenGL: lambda pipe: (pipe.stencilState.stencilEnable, pipe.stencilState.frontFace,
+                                         pipe.stencilState.backFace),
+    rd.GraphicsAPI.Vulkan: lambda pipe: (pipe.depthStencil.stencilTestEnable, pipe.depthStencil.frontFace,
+                                         pipe.depthStencil.backFace),
+    rd.GraphicsAPI.D3D11: lambda pipe: (pipe.outputMerger.depthStencilState.stencilEnable,
+                                        pipe.outputMerger.depthStencilState.frontFace,
+                                        pipe.outputMerger.depthStencilState.backFace),
+    rd.GraphicsAPI.D3D12: lambda pipe: (pipe.outputMerger.depthStencilState.stencilEnable,
+                                        pipe.outputMerger.depthStencilState.frontFace,
+                                        pipe.outputMerger.depthStencilState.backFace),
+}
+
+
+def default_stencil_state(pipe):
+    return False, rd.StencilFace(), rd.StencilFace()
+
+
+# The checks made on the stencil face states, in order. Each has a message formatted with the test that failed and the
+# face state, whether matching on both faces means we've found the problem, and the compare functions it applies to.
+# Each compare function maps to a predicate on the face's reference and compare mask, or None if the function alone
+# matches, so faces using any other function are skipped with a single lookup.
+stencil_face_checks = [
+    # Simple cases that can't ever be true
+    ('The stencil {test} is set to Never, meaning it always fails.', True,
+     {rd.CompareFunction.Never: None}),
+    ('The stencil {test} is set to {s.function} than {s.reference}, which is impossible.', True,
+     {rd.CompareFunction.Less: lambda face: face.reference == 0,
+      rd.CompareFunction.Greater: lambda face: face.reference == 255}),
+    ('The stencil {test} is set to {s.function} than {s.reference}, which is impossible.', True,
+     {rd.CompareFunction.LessEqual: lambda face: face.reference < 0,
+      rd.CompareFunction.GreaterEqual: lambda face: face.reference > 255}),
+
+    # compareMask being 0 is almost certainly a problem, but we can't *prove* it except in certain circumstances.
+    # e.g. having a compareMask of 0 and a reference of 0 would pass, or less than a non-zero reference.
+    # Fortunately, most of the cases we can prove will catch common errors. At least errors that cause a draw to
+    # not show up.
+
+    # if the compareMask is set such that the reference value can never be achieved, that's a guaranteed failure
+    ('The stencil {test} is set to compare equal to {s.reference}, but the compare mask is {s.compareMask:x} '
+     'meaning it never can.', True,
+     {rd.CompareFunction.Equal: lambda face: (face.compareMask & face.reference) != face.reference and
+                                             face.reference != 0}),
+
+    # The compareMask is the largest value that can be read, if the test is such that only larger values would pass,
+    # that's also broken.
+    ('The stencil {test} is set to compare greater than {s.reference}, but the compare mask is {s.compareMask:x} '
+     'meaning it never can.', True,
+     {rd.CompareFunction.Greater: lambda face: face.compareMask <= face.reference}),
+    ('The stencil {test} is set to compare greater than or equal to {s.reference}, but the compare mask is '
+     '{s.compareMask:x} meaning it never can.', True,
+     {rd.CompareFunction.GreaterEqual: lambda face: face.compareMask < face.reference}),
+
+    # Equal stencil testing is often used but not equal is rare - flag it too. We're not actually finished even if
+    # both faces are not equal!
+    ('The stencil {test} is set to Not Equal, which is not a problem but is unusual.', False,
+     {rd.CompareFunction.NotEqual: None}),
+]
+
+
+# Appended to a check's message when only one face matches it, since the draw may only use the other face
+front_face_hint = ' If your draw relies on front faces then this could be the problem.'
+back_face_hint = ' If your draw relies on back faces then this could be the problem.'
+
+
+def stencil_face_matches(face: StencilFaceState, checks):
+    if face.function not in checks:
+        return False
+    check = checks[face.function]
+    return check is None or check(face)
+
+
+# Returns the sample mask that will be applied when rendering to targets with the given sample count
+def gl_sample_mask(pipe: rd.GLState, sample_count: int):
+    # GL only applies the sample mask in MSAA scenarios
+    rs_state = pipe.rasterizer.state
+    if sample_count > 1 and rs_state.multisampleEnable and rs_state.sampleMask:
+        return rs_state.sampleMaskValue
+    return 0xFFFFFFFF
+
+
+def default_sample_mask(pipe, sample_count: int):
+    return 0xFFFFFFFF
+
+
+# D3D always applies the sample mask
+sample_mask_getters = {
+    rd.GraphicsAPI.OpenGL: gl_sample_mask,
+    rd.GraphicsAPI.Vulkan: lambda pipe, sample_count: pipe.multisample.sampleMask,
+    rd.GraphicsAPI.D3D11: lambda pipe, sample_count: pipe.outputMerger.blendState.sampleMask,
+    rd.GraphicsAPI.D3D12: lambda pipe, sample_count: pipe.rasterizer.sampleMask,
+}
+
+
+# Returns the blend factor, and whether depth writes are enabled. Depth writes only count if depth testing is enabled.
+blend_output_getters = {
+    rd.GraphicsAPI.OpenGL: lambda pipe: (pipe.framebuffer.blendState.blendFactor,
+                                         pipe.depthState.depthEnable and pipe.depthState.depthWrites),
+    rd.GraphicsAPI.Vulkan: lambda pipe: (pipe.colorBlend.blendFactor,
+                                         pipe.depthStencil.depthTestEnable and pipe.depthStencil.depthWriteEnable),
+    rd.GraphicsAPI.D3D11: lambda pipe: (pipe.outputMerger.blendState.blendFactor,
+                                        pipe.outputMerger.depthStencilState.depthEnable and
+                                        pipe.outputMerger.depthStencilState.depthWrites),
+    rd.GraphicsAPI.D3D12: lambda pipe: (pipe.outputMerger.blendState.blendFactor,
+                                        pipe.outputMerger.depthStencilState.depthEnable and
+                                        pipe.outputMerger.depthStencilState.depthWrites),
+}
+
+
+def default_blend_output(pipe):
+    return (0.0, 0.0, 0.0, 0.0), False
+
+
+# Depth clear values paired with depth functions that can never pass against them, and ones that are very unlikely to
+# be intended since only a few values could pass
+impossible_depth_clears = frozenset({(1.0, rd.CompareFunction.Greater), (0.0, rd.CompareFunction.Less)})
+unlikely_depth_clears = frozenset({(1.0, rd.CompareFunction.GreaterEqual), (0.0, rd.CompareFunction.LessEqual)})
+
+# Resource usages that could have written new data into a buffer
+buffer_write_usages = frozenset({rd.ResourceUsage.VS_RWResource, rd.ResourceUsage.HS_RWResource,
+                                 rd.ResourceUsage.DS_RWResource, rd.ResourceUsage.GS_RWResource,
+                                 rd.ResourceUsage.PS_RWResource, rd.ResourceUsage.CS_RWResource,
+                                 rd.ResourceUsage.All_RWResource,
+                                 rd.ResourceUsage.Copy, rd.ResourceUsage.StreamOut,
+                                 rd.ResourceUsage.CopyDst, rd.ResourceUsage.Discard, rd.ResourceUsage.CPUWrite})
+
+# Blend multipliers that read the source color or alpha
+source_blend_multipliers = frozenset({rd.BlendMultiplier.SrcCol, rd.BlendMultiplier.InvSrcCol,
+                                      rd.BlendMultiplier.SrcAlpha, rd.BlendMultiplier.InvSrcAlpha,
+                                      rd.BlendMultiplier.SrcAlphaSat, rd.BlendMultiplier.Src1Col,
+                                      rd.BlendMultiplier.InvSrc1Col, rd.BlendMultiplier.Src1Alpha,
+                                      rd.BlendMultiplier.InvSrc1Alpha})
+
+# The first mip/slice/sample, which overlays and min/max queries are read from. This is never modified so it can be
+# shared rather than constructing a new one for every query.
+first_subresource = rd.Subresource()
+
+# Backgrounds for the clear before draw overlay. Assigning these to a TextureDisplay copies them, so likewise they are
+# shared for every target and sample.
+black_background = rd.FloatVector(0.0, 0.0, 0.0, 0.0)
+white_background = rd.FloatVector(1.0, 1.0, 1.0, 1.0)
+
+
+# Iterates over the flat indices of each pixel covered in drawcall overlay data. Only the first of the four 16-bit
+# channels matters, so view just that channel and let compress() skip uncovered pixels without looping in python.
+def covered_pixel_indices(overlay_data, width: int, height: int):
+    red = memoryview(overlay_data).cast('H')[0::4]
+    return itertools.compress(range(width * height), red)
+
+
+# Iterates over the x,y co-ordinates of each pixel covered in drawcall overlay data
+def covered_pixels(overlay_data, width: int, height: int):
+    for idx in covered_pixel_indices(overlay_data, width, height):
+        yield idx % width, idx // width
+
+
 class Analysis:
     # Do the expensive analysis on the replay thread
     def __init__(self, ctx: qrd.CaptureContext, eid: int, r: rd.ReplayController):
@@ -77,19 +333,24 @@ class Analysis:
         self.drawcall = self.ctx.GetAction(self.eid)
         self.api_properties = self.r.GetAPIProperties()
         self.textures = self.r.GetTextures()
+        self.tex_lookup = {t.resourceId: t for t in self.textures}
         self.buffers = self.r.GetBuffers()
+        self.buf_lookup = {b.resourceId: b for b in self.buffers}
         self.api = self.api_properties.pipelineType
 
         self.pipe = self.r.GetPipelineState()
-        self.glpipe = self.vkpipe = self.d3d11pipe = self.d3d12pipe = None
-        if self.api == rd.GraphicsAPI.OpenGL:
-            self.glpipe = self.r.GetGLPipelineState()
-        elif self.api == rd.GraphicsAPI.Vulkan:
-            self.vkpipe = self.r.GetVulkanPipelineState()
-        elif self.api == rd.GraphicsAPI.D3D11:
-            self.d3d11pipe = self.r.GetD3D11PipelineState()
-        elif self.api == rd.GraphicsAPI.D3D12:
-            self.d3d12pipe = self.r.GetD3D12PipelineState()
+        self.api_pipe = api_pipe_getters[self.api](self.r) if self.api in api_pipe_getters else None
+
+        # Snapshot the state the checks need from the API-specific state, so each check doesn't have to go back through
+        # the API-specific accessors
+        self.cull_state = CullState(*cull_state_getters.get(self.api, default_cull_state)(self.api_pipe))
+        self.raster_discard = raster_discard_getters.get(self.api, default_raster_discard)(self.api_pipe)
+        self.depth_state = DepthState(*depth_state_getters.get(self.api, default_depth_state)(self.api_pipe))
+        self.stencil_state = StencilState(*stencil_state_getters.get(self.api, default_stencil_state)(self.api_pipe))
+
+        # Viewport and scissor state are fixed for this event, so fetch them once for all the checks
+        self.viewport = self.pipe.GetViewport(0)
+        self.scissor = self.pipe.GetScissor(0)
 
         self.vert_ndc = []
 
@@ -113,22 +374,78 @@ class Analysis:
                 rd.ShaderStage.Hull) == rd.ResourceId.Null():
             self.postvs_stage = rd.MeshDataStage.VSOut
 
-        # Gather all the postvs positions together
-        self.postvs_positions = []
-        for inst in range(max(1, self.drawcall.numInstances)):
-            for view in range(max(1, self.pipe.MultiviewBroadcastCount())):
-                postvs = self.r.GetPostVSData(inst, view, self.postvs_stage)
-                pos_data = self.r.GetBufferData(postvs.vertexResourceId, postvs.vertexByteOffset,
-                                                postvs.vertexByteStride * postvs.numIndices)
-                for vert in range(postvs.numIndices):
-                    if vert * postvs.vertexByteStride + 16 < len(pos_data):
-                        self.postvs_positions.append(struct.unpack_from("4f", pos_data, vert * postvs.vertexByteStride))
+        # Gather all the postvs mesh data for each instance and view
+        postvs_meshes = []
+        inst_count = max(1, self.drawcall.numInstances)
+        view_count = max(1, self.pipe.MultiviewBroadcastCount())
+        for inst in range(inst_count):
+            for view in range(view_count):
+                postvs_meshes.append(self.r.GetPostVSData(inst, view, self.postvs_stage))
+
+        # Instances and views generally share one buffer, so find the range used in each buffer and fetch it all at
+        # once instead of making a round-trip for every instance and view.
+        buffer_ranges = {}
+        for postvs in postvs_meshes:
+            size = postvs.vertexByteStride * postvs.numIndices
+            if size == 0:
+                continue
+            start = postvs.vertexByteOffset
+            end = start + size
+            if postvs.vertexResourceId in buffer_ranges:
+                prev_start, prev_end = buffer_ranges[postvs.vertexResourceId]
+                start = min(start, prev_start)
+                end = max(end, prev_end)
+            buffer_ranges[postvs.vertexResourceId] = (start, end)
+
+        buffer_data = {}
+        for resid, (start, end) in buffer_ranges.items():
+            buffer_data[resid] = (start, memoryview(self.r.GetBufferData(resid, start, end - start)))
+
+        # Gather all the postvs positions together, projecting them to NDC as they're unpacked so the raw positions
+        # are never stored. Vertices with W=0 can't be divided so they're skipped, but still counted.
+        self.num_postvs_positions = 0
+
+        # The NDC positions can only be read as consecutive triangles if every mesh is an unindexed list of whole
+        # triangles, and no vertices are skipped
+        self.ndc_triangle_list = True
+
+        for postvs in postvs_meshes:
+            if postvs.topology != rd.Topology.TriangleList or postvs.indexResourceId != rd.ResourceId.Null():
+                self.ndc_triangle_list = False
+
+            if postvs.vertexResourceId not in buffer_data:
+                continue
+            # The position is always a float4 at the start of each vertex
+            stride = postvs.vertexByteStride
+            if stride < 16:
+                continue
+            start, data = buffer_data[postvs.vertexResourceId]
+            offs = postvs.vertexByteOffset - start
+            pos_data = data[offs:offs + stride * postvs.numIndices]
+
+            # Unpack all the whole vertices in one go, skipping the rest of each vertex after the position as padding
+            num_verts = len(pos_data) // stride
+            vert_struct = struct.Struct('4f{}x'.format(stride - 16))
+            positions = vert_struct.iter_unpack(pos_data[0:num_verts * stride])
 
-        self.vert_ndc = [(vert[0] / vert[3], vert[1] / vert[3], vert[2] / vert[3]) for vert in self.postvs_positions if
-                         vert[3] != 0.0]
+            # If the data was truncated, the last vertex may still have a complete position
+            if len(pos_data) - num_verts * stride >= 16:
+                positions = itertools.chain(positions, [struct.unpack_from('4f', pos_data, num_verts * stride)])
+                num_verts += 1
 
-        # Create a temporary offscreen output we'll use for
-        self.out = self.r.CreateOutput(rd.CreateHeadlessWindowingData(dim[0], dim[1]), rd.ReplayOutputType.Texture)
+            if num_verts % 3 != 0:
+                self.ndc_triangle_list = False
+
+            self.num_postvs_positions += num_verts
+            self.vert_ndc.extend((x / w, y / w, z / w) for x, y, z, w in positions if w != 0.0)
+
+        if len(self.vert_ndc) != self.num_postvs_positions:
+            self.ndc_triangle_list = False
+
+        # The temporary offscreen output we'll use for rendering overlays is only created when first needed, since
+        # many draws finish analysis before rendering any
+        self.out = None
+        self.out_dim = dim
 
         self.tex_display = rd.TextureDisplay()
 
@@ -163,7 +480,8 @@ class Analysis:
         except AnalysisFinished:
             pass
         finally:
-            self.out.Shutdown()
+            if self.out is not None:
+                self.out.Shutdown()
 
             self.r.SetFrameEvent(self.eid, False)
 
@@ -183,14 +501,14 @@ class Analysis:
             comp_type = self.target_descs[0].format.compType
 
         if comp_type == rd.CompType.SInt:
-            self.tex_display.rangeMin = float(min([texmin.intValue[x] for x in range(4)]))
-            self.tex_display.rangeMax = float(max([texmax.intValue[x] for x in range(4)]))
+            vmin, vmax = texmin.intValue, texmax.intValue
         elif comp_type == rd.CompType.UInt:
-            self.tex_display.rangeMin = float(min([texmin.uintValue[x] for x in range(4)]))
-            self.tex_display.rangeMax = float(max([texmax.uintValue[x] for x in range(4)]))
+            vmin, vmax = texmin.uintValue, texmax.uintValue
         else:
-            self.tex_display.rangeMin = min([texmin.floatValue[x] for x in range(4)])
-            self.tex_display.rangeMax = max([texmax.floatValue[x] for x in range(4)])
+            vmin, vmax = texmin.floatValue, texmax.floatValue
+
+        self.tex_display.rangeMin = float(min(vmin[0], vmin[1], vmin[2], vmin[3]))
+        self.tex_display.rangeMax = float(max(vmax[0], vmax[1], vmax[2], vmax[3]))
 
         texmin, texmax = self.get_overlay_minmax(rd.DebugOverlay.Drawcall)
 
@@ -218,35 +536,62 @@ class Analysis:
 
     def get_overlay_minmax(self, overlay: rd.DebugOverlay):
         self.tex_display.overlay = overlay
-        self.out.SetTextureDisplay(self.tex_display)
-        overlay = self.out.GetDebugOverlayTexID()
-        return self.r.GetMinMax(overlay, rd.Subresource(), rd.CompType.Typeless)
+        out = self.get_output()
+        out.SetTextureDisplay(self.tex_display)
+        overlay = out.GetDebugOverlayTexID()
+        return self.r.GetMinMax(overlay, first_subresource, rd.CompType.Typeless)
 
     def get_overlay_histogram(self, tex_display, overlay: rd.DebugOverlay, minmax: Tuple[float, float],
                               channels: Tuple[bool, bool, bool, bool]):
         tex_display.overlay = overlay
-        self.out.SetTextureDisplay(tex_display)
-        overlay = self.out.GetDebugOverlayTexID()
-        return self.r.GetHistogram(overlay, rd.Subresource(), rd.CompType.Typeless, minmax[0], minmax[1], channels)
+        out = self.get_output()
+        out.SetTextureDisplay(tex_display)
+        overlay = out.GetDebugOverlayTexID()
+        return self.r.GetHistogram(overlay, first_subresource, rd.CompType.Typeless, minmax[0], minmax[1], channels)
+
+    def find_covered_pixel(self, overlay: rd.ResourceId, sub: rd.Subresource):
+        dim = self.out_dim
+        v = self.viewport
+
+        # Reading back and scanning the whole overlay is expensive. When the postvs data is a plain triangle list we
+        # know where the first couple of triangles are, so first pick the pixels at their centres. The triangles may
+        # still be clipped or culled so a hit isn't guaranteed, and we don't know which way up the overlay is relative
+        # to NDC so try both.
+        if self.ndc_triangle_list:
+            for tri in range(min(2, len(self.vert_ndc) // 3)):
+                verts = self.vert_ndc[tri * 3:tri * 3 + 3]
+                cx = sum(vert[0] for vert in verts) / 3.0
+                cy = sum(vert[1] for vert in verts) / 3.0
+
+                if not math.isfinite(cx) or not math.isfinite(cy):
+                    continue
+
+                x = int(v.x + (cx * 0.5 + 0.5) * v.width)
+                for y in (int(v.y + (cy * 0.5 + 0.5) * v.height), int(v.y + (0.5 - cy * 0.5) * v.height)):
+                    if 0 <= x < dim[0] and 0 <= y < dim[1]:
+                        if self.r.PickPixel(overlay, x, y, sub, rd.CompType.Typeless).floatValue[0] != 0.0:
+                            return x, y
+
+        # Fall back to reading back the whole overlay and scanning for a covered pixel
+        overlay_data = self.r.GetTextureData(overlay, sub)
+        return next(covered_pixels(overlay_data, dim[0], dim[1]), None)
 
     def check_onscreen(self):
         # It's on-screen we debug the rasterization/testing/blending states
 
-        if self.pipe.GetScissor(0).enabled:
+        if self.scissor.enabled:
             # Check if we're outside scissor first. This overlay is a bit messy because it's not pure red/green,
             # so instead of getting the min and max and seeing if there are green pixels, we get the histogram
             # because any green will show up in the green channel as distinct from white and black.
             texhist = self.get_overlay_histogram(self.tex_display, rd.DebugOverlay.ViewportScissor, (0.0, 1.0),
                                                  (False, True, False, False))
 
-            buckets = list(map(lambda _: _[0], filter(lambda _: _[1] > 0, list(enumerate(texhist)))))
-
             # drop the top buckets, for white, as well as any buckets lower than 20% for the small amounts of green
             # in other colors
-            buckets = [b for b in buckets if len(texhist) // 5 < b < len(texhist) - 1]
+            green_buckets = texhist[len(texhist) // 5 + 1:len(texhist) - 1]
 
             # If there are no green pixels at all, this completely failed
-            if len(buckets) == 0:
+            if not any(green_buckets):
                 self.check_failed_scissor()
 
                 # Regardless of whether we finihsed the analysis above, don't do any more checking.
@@ -256,63 +601,74 @@ class Analysis:
                     ResultStep(msg='Some or all of the draw passes the scissor test, which is enabled',
                                tex_display=self.tex_display))
 
-        texmin, texmax = self.get_overlay_minmax(rd.DebugOverlay.BackfaceCull)
-
-        # If there are no green pixels at all, this completely failed
-        if texmax.floatValue[1] < 0.5:
-            self.check_failed_backface_culling()
-
-            # Regardless of whether we finihsed the analysis above, don't do any more checking.
-            raise AnalysisFinished
-        else:
+        # Overlays are expensive to render, so skip any that the current state means can't show a failure
+        if self.cull_state.cull_mode == rd.CullMode.NoCull:
             self.analysis_steps.append(
-                ResultStep(msg='Some or all of the draw passes backface culling',
-                           tex_display=self.tex_display))
+                ResultStep(msg='Backface culling is disabled, so the draw passes backface culling',
+                           pipe_stage=qrd.PipelineStage.Rasterizer))
+        else:
+            texmin, texmax = self.get_overlay_minmax(rd.DebugOverlay.BackfaceCull)
 
-        texmin, texmax = self.get_overlay_minmax(rd.DebugOverlay.Depth)
+            # If there are no green pixels at all, this completely failed
+            if texmax.floatValue[1] < 0.5:
+                self.check_failed_backface_culling()
 
-        # If there are no green pixels at all, this completely failed
-        if texmax.floatValue[1] < 0.5:
-            self.check_failed_depth()
+                # Regardless of whether we finihsed the analysis above, don't do any more checking.
+                raise AnalysisFinished
+            else:
+                self.analysis_steps.append(
+                    ResultStep(msg='Some or all of the draw passes backface culling',
+                               tex_display=self.tex_display))
 
-            # Regardless of whether we finihsed the analysis above, don't do any more checking.
-            raise AnalysisFinished
-        else:
+        # Without a depth-stencil target there's nothing to test against, so depth and stencil testing can't fail
+        has_depth = self.depth.resource != rd.ResourceId.Null()
+
+        # If depth testing, depth bounds testing and depth clipping are all disabled then nothing can fail, so don't
+        # bother rendering the overlay
+        if not (has_depth and (self.depth_state.enabled or self.depth_state.bounds)) and self.depth_state.clamp:
             self.analysis_steps.append(
-                ResultStep(msg='Some or all of the draw passes depth testing',
-                           tex_display=self.tex_display))
+                ResultStep(msg='Depth testing and depth bounds testing are disabled or have no depth target, and depth '
+                               'clipping is disabled, so the draw passes depth testing',
+                           pipe_stage=qrd.PipelineStage.DepthTest))
+        else:
+            texmin, texmax = self.get_overlay_minmax(rd.DebugOverlay.Depth)
 
-        texmin, texmax = self.get_overlay_minmax(rd.DebugOverlay.Stencil)
+            # If there are no green pixels at all, this completely failed
+            if texmax.floatValue[1] < 0.5:
+                self.check_failed_depth()
 
-        # If there are no green pixels at all, this completely failed
-        if texmax.floatValue[1] < 0.5:
-            self.check_failed_stencil()
+                # Regardless of whether we finihsed the analysis above, don't do any more checking.
+                raise AnalysisFinished
+            else:
+                self.analysis_steps.append(
+                    ResultStep(msg='Some or all of the draw passes depth testing',
+                               tex_display=self.tex_display))
 
-            # Regardless of whether we finihsed the analysis above, don't do any more checking.
-            raise AnalysisFinished
-        else:
+        # Similarly if stencil testing is disabled it can't fail
+        if not has_depth or not self.stencil_state.enabled:
             self.analysis_steps.append(
-                ResultStep(msg='Some or all of the draw passes stencil testing',
-                           tex_display=self.tex_display))
+                ResultStep(msg='Stencil testing is disabled, so the draw passes stencil testing',
+                           pipe_stage=qrd.PipelineStage.StencilTest))
+        else:
+            texmin, texmax = self.get_overlay_minmax(rd.DebugOverlay.Stencil)
+
+            # If there are no green pixels at all, this completely failed
+            if texmax.floatValue[1] < 0.5:
+                self.check_failed_stencil()
+
+                # Regardless of whether we finihsed the analysis above, don't do any more checking.
+                raise AnalysisFinished
+            else:
+                self.analysis_steps.append(
+                    ResultStep(msg='Some or all of the draw passes stencil testing',
+                               tex_display=self.tex_display))
 
         sample_count = self.target_descs[0].msSamp
 
         # OK we've exhausted the help we can get overlays!
 
         # Check that the sample mask isn't 0, which will cull the draw
-        sample_mask = 0xFFFFFFFF
-        if self.api == rd.GraphicsAPI.OpenGL:
-            # GL only applies the sample mask in MSAA scenarios
-            if (sample_count > 1 and self.glpipe.rasterizer.state.multisampleEnable and
-                    self.glpipe.rasterizer.state.sampleMask):
-                sample_mask = self.glpipe.rasterizer.state.sampleMaskValue
-        elif self.api == rd.GraphicsAPI.Vulkan:
-            sample_mask = self.vkpipe.multisample.sampleMask
-        elif self.api == rd.GraphicsAPI.D3D11:
-            # D3D always applies the sample mask
-            sample_mask = self.d3d11pipe.outputMerger.blendState.sampleMask
-        elif self.api == rd.GraphicsAPI.D3D12:
-            sample_mask = self.d3d12pipe.rasterizer.sampleMask
+        sample_mask = sample_mask_getters.get(self.api, default_sample_mask)(self.api_pipe, sample_count)
 
         if sample_mask == 0:
             self.analysis_steps.append(ResultStep(
@@ -335,7 +691,7 @@ class Analysis:
 
         # On GL, check the sample coverage value for MSAA targets
         if self.api == rd.GraphicsAPI.OpenGL:
-            rs_state = self.glpipe.rasterizer.state
+            rs_state = self.api_pipe.rasterizer.state
             if sample_count > 1 and rs_state.multisampleEnable and rs_state.sampleCoverage:
                 if rs_state.sampleCoverageInvert and rs_state.sampleCoverageValue >= 1.0:
                     self.analysis_steps.append(ResultStep(
@@ -359,37 +715,15 @@ class Analysis:
         blends = self.pipe.GetColorBlends()
         targets = self.pipe.GetOutputTargets()
 
-        # Consider a write mask enabled if the corresponding target is unbound, to avoid false positives
-        enabled_color_masks = []
-        color_blends = []
-        for i, b in enumerate(blends):
-            if i >= len(targets) or targets[i].resource == rd.ResourceId.Null():
-                color_blends.append(None)
-            else:
-                enabled_color_masks.append(b.writeMask != 0)
-                color_blends.append(b)
+        # Only consider the blend state for bound targets, to avoid false positives. Each is paired with its output
+        # index for reporting.
+        bound_blends = [(i, b) for i, b in enumerate(blends)
+                        if i < len(targets) and targets[i].resource != rd.ResourceId.Null()]
 
-        blend_factor = (0.0, 0.0, 0.0, 0.0)
-        depth_writes = False
-        if self.api == rd.GraphicsAPI.OpenGL:
-            blend_factor = self.glpipe.framebuffer.blendState.blendFactor
-            if self.glpipe.depthState.depthEnable:
-                depth_writes = self.glpipe.depthState.depthWrites
-        elif self.api == rd.GraphicsAPI.Vulkan:
-            blend_factor = self.vkpipe.colorBlend.blendFactor
-            if self.vkpipe.depthStencil.depthTestEnable:
-                depth_writes = self.vkpipe.depthStencil.depthWriteEnable
-        elif self.api == rd.GraphicsAPI.D3D11:
-            blend_factor = self.d3d11pipe.outputMerger.blendState.blendFactor
-            if self.d3d11pipe.outputMerger.depthStencilState.depthEnable:
-                depth_writes = self.d3d11pipe.outputMerger.depthStencilState.depthWrites
-        elif self.api == rd.GraphicsAPI.D3D12:
-            blend_factor = self.d3d12pipe.outputMerger.blendState.blendFactor
-            if self.d3d12pipe.outputMerger.depthStencilState.depthEnable:
-                depth_writes = self.d3d12pipe.outputMerger.depthStencilState.depthWrites
+        blend_factor, depth_writes = blend_output_getters.get(self.api, default_blend_output)(self.api_pipe)
 
         # if all color masks are disabled, at least warn - or consider the case solved if depth writes are also disabled
-        if not any(enabled_color_masks):
+        if not any(b.writeMask != 0 for _, b in bound_blends):
             if depth_writes:
                 self.analysis_steps.append(ResultStep(
                     msg='All bound output targets have a write mask set to 0 - which means no color will be '
@@ -407,7 +741,7 @@ class Analysis:
 
         # if only some color masks are disabled, alert the user since they may be wondering why nothing is being output
         # to that target
-        elif not all(enabled_color_masks):
+        elif not all(b.writeMask != 0 for _, b in bound_blends):
             self.analysis_steps.append(ResultStep(
                 msg='Some output targets have a write mask set to 0 - which means no color will be '
                     'written to those targets.\n\n '
@@ -418,49 +752,42 @@ class Analysis:
                 ResultStep(msg='The color write masks seem to be set normally.',
                            pipe_stage=qrd.PipelineStage.Blending))
 
-        def is_zero(mul: rd.BlendMultiplier):
-            if mul == rd.BlendMultiplier.Zero:
-                return True
-            if mul == rd.BlendMultiplier.FactorAlpha and blend_factor[3] == 0.0:
-                return True
-            if mul == rd.BlendMultiplier.FactorRGB and blend_factor[0:3] == (0.0, 0.0, 0.0):
-                return True
-            if mul == rd.BlendMultiplier.InvFactorAlpha and blend_factor[3] == 1.0:
-                return True
-            if mul == rd.BlendMultiplier.InvFactorRGB and blend_factor[0:3] == (1.0, 1.0, 1.0):
-                return True
-            return False
-
-        def uses_src(mul: rd.BlendMultiplier):
-            return mul in [rd.BlendMultiplier.SrcCol, rd.BlendMultiplier.InvSrcCol, rd.BlendMultiplier.SrcAlpha,
-                           rd.BlendMultiplier.InvSrcAlpha,
-                           rd.BlendMultiplier.SrcAlphaSat, rd.BlendMultiplier.Src1Col, rd.BlendMultiplier.InvSrc1Col,
-                           rd.BlendMultiplier.Src1Alpha, rd.BlendMultiplier.InvSrc1Alpha]
+        # The blend multipliers that work out to zero with the current blend factor
+        blend_rgb = tuple(blend_factor[0:3])
+        zero_multipliers = {rd.BlendMultiplier.Zero}
+        if blend_factor[3] == 0.0:
+            zero_multipliers.add(rd.BlendMultiplier.FactorAlpha)
+        if blend_factor[3] == 1.0:
+            zero_multipliers.add(rd.BlendMultiplier.InvFactorAlpha)
+        if blend_rgb == (0.0, 0.0, 0.0):
+            zero_multipliers.add(rd.BlendMultiplier.FactorRGB)
+        if blend_rgb == (1.0, 1.0, 1.0):
+            zero_multipliers.add(rd.BlendMultiplier.InvFactorRGB)
 
         # Look for any enabled color blend equations that would work out to 0, or not use the source data
         blend_warnings = ''
-        for i, b in enumerate(color_blends):
-            if b is not None:
-                if b.enabled:
-                    # All operations use both operands in some sense so we can't count out any blend equation with just
-                    # that
-                    if is_zero(b.colorBlend.source) and not uses_src(b.colorBlend.destination):
-                        blend_warnings += 'Blending on output {} effectively multiplies the source color by zero, ' \
-                                          'and the destination color is multiplied by {}, so the source color is ' \
-                                          'completely unused.'.format(i, b.colorBlend.destination)
-
-                    # we don't warn on alpha state since it's sometimes only used for the color
-                elif b.logicOperationEnabled:
-                    if b.logicOperation == rd.LogicOperation.NoOp:
-                        blend_warnings += 'Blending on output {} is set to use logic operations, and the operation ' \
-                                          'is no-op.\n'.format(i)
+        for i, b in bound_blends:
+            if b.enabled:
+                # All operations use both operands in some sense so we can't count out any blend equation with just
+                # that
+                if b.colorBlend.source in zero_multipliers and \
+                        b.colorBlend.destination not in source_blend_multipliers:
+                    blend_warnings += 'Blending on output {} effectively multiplies the source color by zero, ' \
+                                      'and the destination color is multiplied by {}, so the source color is ' \
+                                      'completely unused.'.format(i, b.colorBlend.destination)
+
+                # we don't warn on alpha state since it's sometimes only used for the color
+            elif b.logicOperationEnabled:
+                if b.logicOperation == rd.LogicOperation.NoOp:
+                    blend_warnings += 'Blending on output {} is set to use logic operations, and the operation ' \
+                                      'is no-op.\n'.format(i)
 
         if blend_warnings != '':
             self.analysis_steps.append(ResultStep(
                 msg='Some color blending state is strange, but not necessarily unintentional. This is worth '
                     'checking if you haven\'t set this up deliberately:\n\n{}'.format(blend_warnings),
                 pipe_stage=qrd.PipelineStage.Blending))
-        elif any([b is not None and b.enabled for b in color_blends]):
+        elif any(b.enabled for _, b in bound_blends):
             self.analysis_steps.append(
                 ResultStep(msg='The blend equations seem to be set up to allow rendering.',
                            pipe_stage=qrd.PipelineStage.Blending))
@@ -474,22 +801,23 @@ class Analysis:
         # there.
         for t in targets:
             if t.resource != rd.ResourceId():
-                for sample in range(self.get_tex(t.resource).msSamp):
-                    self.tex_display.resourceId = t.resource
-                    self.tex_display.subresource = rd.Subresource(t.firstMip, t.firstSlice, sample)
-                    self.tex_display.backgroundColor = rd.FloatVector(0.0, 0.0, 0.0, 0.0)
-                    self.tex_display.rangeMin = 0.0
-                    self.tex_display.rangeMax = 1.0
+                # Only the sample and background change per overlay, everything else is the same for the whole target
+                tex_desc = self.get_tex(t.resource)
+                c = min(3, tex_desc.format.compCount)
 
-                    self.get_overlay_minmax(rd.DebugOverlay.ClearBeforeDraw)
-                    texmin, texmax = self.r.GetMinMax(t.resource, rd.Subresource(), t.format.compType)
+                self.tex_display.resourceId = t.resource
+                self.tex_display.rangeMin = 0.0
+                self.tex_display.rangeMax = 1.0
 
-                    tex_desc = self.get_tex(t.resource)
+                for sample in range(tex_desc.msSamp):
+                    self.tex_display.subresource = rd.Subresource(t.firstMip, t.firstSlice, sample)
+                    self.tex_display.backgroundColor = black_background
 
-                    c = min(3, tex_desc.format.compCount)
+                    self.get_overlay_minmax(rd.DebugOverlay.ClearBeforeDraw)
+                    texmin, texmax = self.r.GetMinMax(t.resource, first_subresource, t.format.compType)
 
-                    if any([_ != 0.0 for _ in texmin.floatValue[0:c]]) or \
-                       any([_ != 0.0 for _ in texmax.floatValue[0:c]]):
+                    if any(_ != 0.0 for _ in texmin.floatValue[0:c]) or \
+                       any(_ != 0.0 for _ in texmax.floatValue[0:c]):
                         self.analysis_steps.append(ResultStep(
                             msg='The target {} did show a change in RGB when selecting the \'clear before draw\' '
                                 'overlay on a black background. Perhaps your shader is outputting the color that is '
@@ -507,13 +835,13 @@ class Analysis:
 
                         raise AnalysisFinished
 
-                    self.tex_display.backgroundColor = rd.FloatVector(1.0, 1.0, 1.0, 1.0)
+                    self.tex_display.backgroundColor = white_background
 
                     self.get_overlay_minmax(rd.DebugOverlay.ClearBeforeDraw)
-                    texmin, texmax = self.r.GetMinMax(t.resource, rd.Subresource(), t.format.compType)
+                    texmin, texmax = self.r.GetMinMax(t.resource, first_subresource, t.format.compType)
 
-                    if any([_ != 1.0 for _ in texmin.floatValue[0:c]]) or \
-                       any([_ != 1.0 for _ in texmax.floatValue[0:c]]):
+                    if any(_ != 1.0 for _ in texmin.floatValue[0:c]) or \
+                       any(_ != 1.0 for _ in texmax.floatValue[0:c]):
                         self.analysis_steps.append(ResultStep(
                             msg='The target {} did show a change in RGB when selecting the \'clear before draw\' '
                                 'overlay on a white background. Perhaps your shader is outputting the color that is '
@@ -538,25 +866,19 @@ class Analysis:
         # would
         if self.api_properties.pixelHistory:
             self.tex_display.overlay = rd.DebugOverlay.Drawcall
-            self.out.SetTextureDisplay(self.tex_display)
-            overlay = self.out.GetDebugOverlayTexID()
+            out = self.get_output()
+            out.SetTextureDisplay(self.tex_display)
+            overlay = out.GetDebugOverlayTexID()
 
             sub = rd.Subresource(self.tex_display.subresource.mip, 0, 0)
 
             drawcall_overlay_data = self.r.GetTextureData(overlay, sub)
 
-            dim = self.out.GetDimensions()
-
-            # Scan for all pixels that are covered, since we'll have to try a few
-            covered_list = []
-            for y in range(dim[1]):
-                for x in range(dim[0]):
-                    pixel_data = struct.unpack_from('4H', drawcall_overlay_data, (y * dim[0] + x) * 8)
-                    if pixel_data[0] != 0:
-                        covered_list.append((x, y))
+            dim = self.out_dim
 
-            # Shuffle the covered pixels
-            random.shuffle(covered_list)
+            # Scan for all pixels that are covered, since we'll have to try a few. Keep them as flat indices so we only
+            # build co-ordinates for the ones we try.
+            covered_list = list(covered_pixel_indices(drawcall_overlay_data, dim[0], dim[1]))
 
             # how many times should we try? Let's go conservative
             attempts = 5
@@ -564,8 +886,10 @@ class Analysis:
 
             attempts = min(attempts, len(covered_list))
 
-            for attempt in range(attempts):
-                covered = covered_list[attempt]
+            # Pick the covered pixels to try at random. Sampling only the few we need avoids shuffling every covered
+            # pixel when the draw covers most of the target.
+            for idx in random.sample(covered_list, attempts):
+                covered = (idx % dim[0], idx // dim[0])
 
                 history = self.r.PixelHistory(self.targets[0].resource, covered[0], covered[1],
                                               self.tex_display.subresource,
@@ -576,7 +900,8 @@ class Analysis:
                     continue
                 elif history[-1].Passed():
                     alpha = history[-1].shaderOut.col.floatValue[3]
-                    blend = color_blends[0]
+                    # The blend state for the first bound target, which is the one we ran pixel history on
+                    blend = bound_blends[0][1] if bound_blends else None
                     if blend is None:
                         blend = rd.ColorBlend()
                         blend.enabled = False
@@ -612,8 +937,8 @@ class Analysis:
                                'history.'))
 
     def check_failed_scissor(self):
-        v = self.pipe.GetViewport(0)
-        s = self.pipe.GetScissor(0)
+        v = self.viewport
+        s = self.scissor
 
         s_right = s.x + s.width
         s_bottom = s.y + s.height
@@ -646,7 +971,7 @@ class Analysis:
         raise AnalysisFinished
 
     def check_offscreen(self):
-        v = self.pipe.GetViewport(0)
+        v = self.viewport
 
         if v.width <= 1.0 or abs(v.height) <= 1.0:
             self.analysis_steps.append(
@@ -667,7 +992,7 @@ class Analysis:
                            pipe_stage=qrd.PipelineStage.ViewportsScissors))
 
         if self.api == rd.GraphicsAPI.Vulkan:
-            ra = self.vkpipe.currentPass.renderArea
+            ra = self.api_pipe.currentPass.renderArea
 
             # if the render area is empty that's certainly not intentional.
             if ra.width == 0 or ra.height == 0:
@@ -685,14 +1010,13 @@ class Analysis:
                     pipe_stage=qrd.PipelineStage.Rasterizer))
 
         # Check rasterizer discard state
-        if (self.glpipe is not None and self.glpipe.vertexProcessing.discard) or (
-                self.vkpipe is not None and self.vkpipe.rasterizer.rasterizerDiscardEnable):
+        if self.raster_discard:
             self.analysis_steps.append(ResultStep(
                 msg='Rasterizer discard is enabled. This API state disables rasterization for the drawcall.',
                 pipe_stage=qrd.PipelineStage.Rasterizer))
 
             raise AnalysisFinished
-        elif self.glpipe is not None or self.vkpipe is not None:
+        elif self.raster_discard is not None:
             self.analysis_steps.append(ResultStep(
                 msg='Rasterizer discard is not enabled, so that should be fine.',
                 pipe_stage=qrd.PipelineStage.Rasterizer))
@@ -730,19 +1054,19 @@ class Analysis:
 
             raise AnalysisFinished
 
-        if len(self.vert_ndc) == 0 and len(self.postvs_positions) != 0:
+        if len(self.vert_ndc) == 0 and self.num_postvs_positions != 0:
             self.analysis_steps.append(ResultStep(
                 msg='All of the post-transform vertex positions have W=0.0 which is invalid, you should check your '
                     'vertex tranformation setup.',
                 mesh_view=self.postvs_stage))
-        elif len(self.vert_ndc) < len(self.postvs_positions):
+        elif len(self.vert_ndc) < self.num_postvs_positions:
             self.analysis_steps.append(ResultStep(
                 msg='Some of the post-transform vertex positions have W=0.0 which is invalid, you should check your '
                     'vertex tranformation setup.',
                 mesh_view=self.postvs_stage))
 
-        vert_ndc_x = list(filter(lambda _: math.isfinite(_), [vert[0] for vert in self.vert_ndc]))
-        vert_ndc_y = list(filter(lambda _: math.isfinite(_), [vert[1] for vert in self.vert_ndc]))
+        vert_ndc_x = [x for x, _, _ in self.vert_ndc if math.isfinite(x)]
+        vert_ndc_y = [y for _, y, _ in self.vert_ndc if math.isfinite(y)]
 
         if len(vert_ndc_x) == 0 or len(vert_ndc_y) == 0:
             self.analysis_steps.append(ResultStep(
@@ -763,7 +1087,7 @@ class Analysis:
         # (if the input data is broken/empty the vertices may all be transformed to a point).
 
         # project the NDC min/max onto the viewport and see how much of a pixel it covers
-        v = self.pipe.GetViewport(0)
+        v = self.viewport
         top_left = ((v_min[0] * 0.5 + 0.5) * v.width, (v_min[1]*0.5 + 0.5) * v.height)
         bottom_right = ((v_max[0] * 0.5 + 0.5) * v.width, (v_max[1]*0.5 + 0.5) * v.height)
 
@@ -1090,29 +1414,24 @@ class Analysis:
                     # get the unique set of vertices
                     unique_vertices = list(set(vert_bytes))
 
-                    # get all usages of the buffer before this event
-                    buf_usage = [u for u in self.r.GetUsage(vb.resourceId) if u.eventId < self.eid]
+                    # usages are in event order, so walk back from the end to find the last write before this event
+                    last_write = None
+                    for u in reversed(self.r.GetUsage(vb.resourceId)):
+                        if u.eventId < self.eid and u.usage in buffer_write_usages:
+                            last_write = u
+                            break
 
-                    # trim to only write usages
-                    write_usages = [rd.ResourceUsage.VS_RWResource, rd.ResourceUsage.HS_RWResource,
-                                    rd.ResourceUsage.DS_RWResource, rd.ResourceUsage.GS_RWResource,
-                                    rd.ResourceUsage.PS_RWResource, rd.ResourceUsage.CS_RWResource,
-                                    rd.ResourceUsage.All_RWResource,
-                                    rd.ResourceUsage.Copy, rd.ResourceUsage.StreamOut,
-                                    rd.ResourceUsage.CopyDst, rd.ResourceUsage.Discard, rd.ResourceUsage.CPUWrite]
-                    buf_usage = [u for u in buf_usage if u.usage in write_usages]
-
-                    if len(buf_usage) >= 1:
+                    if last_write is not None:
                         buffer_last_mod = '{} was last modified with {} at @{}, you could check that it wrote ' \
-                                          'what you expected.'.format(vb.resourceId, buf_usage[-1].usage,
-                                                                      buf_usage[-1].eventId)
+                                          'what you expected.'.format(vb.resourceId, last_write.usage,
+                                                                      last_write.eventId)
                     else:
                         buffer_last_mod = '{} hasn\'t been modified in this capture, check that you initialised it ' \
                                           'with the correct data or wrote it before the beginning of the ' \
                                           'capture.'.format(vb.resourceId)
 
                     # If all vertices are 0s, give a more specific error message
-                    if not any([any(v) for v in unique_vertices]):
+                    if not any(any(v) for v in unique_vertices):
                         self.analysis_steps.append(ResultStep(
                             msg='Attribute \'{}\' all members are zero. '
                                 'If this is a vertex position attribute then that might be unintentional.\n\n{}'
@@ -1131,24 +1450,8 @@ class Analysis:
                 ResultStep(msg='Didn\'t find any problems with the vertex input setup!'))
 
     def check_failed_backface_culling(self):
-        cull_mode = rd.CullMode.NoCull
-        front = 'Front CW'
-        if self.api == rd.GraphicsAPI.OpenGL:
-            cull_mode = self.glpipe.rasterizer.state.cullMode
-            if self.glpipe.rasterizer.state.frontCCW:
-                front = 'Front: CCW'
-        elif self.api == rd.GraphicsAPI.Vulkan:
-            cull_mode = self.vkpipe.rasterizer.cullMode
-            if self.vkpipe.rasterizer.frontCCW:
-                front = 'Front: CCW'
-        elif self.api == rd.GraphicsAPI.D3D11:
-            cull_mode = self.d3d11pipe.rasterizer.state.cullMode
-            if self.d3d11pipe.rasterizer.state.frontCCW:
-                front = 'Front: CCW'
-        elif self.api == rd.GraphicsAPI.D3D12:
-            cull_mode = self.d3d12pipe.rasterizer.state.cullMode
-            if self.d3d12pipe.rasterizer.state.frontCCW:
-                front = 'Front: CCW'
+        cull_mode, front_ccw = self.cull_state
+        front = 'Front: CCW' if front_ccw else 'Front CW'
 
         self.analysis_steps.append(ResultStep(
             msg='The backface culling overlay shows red, so the draw is completely backface culled.\n\n'
@@ -1162,40 +1465,10 @@ class Analysis:
             msg='The depth test overlay shows red, so the draw is completely failing a depth test.',
             tex_display=self.tex_display))
 
-        v = self.pipe.GetViewport(0)
+        v = self.viewport
 
         # Gather API-specific state
-        depth_func = rd.CompareFunction.AlwaysTrue
-        ndc_bounds = [0.0, 1.0]
-        depth_bounds = []
-        depth_enabled = False
-        depth_clamp = True
-        if self.api == rd.GraphicsAPI.OpenGL:
-            depth_enabled = self.glpipe.depthState.depthEnable
-            if self.glpipe.depthState.depthBounds:
-                depth_bounds = [self.glpipe.depthState.nearBound, self.glpipe.depthState.farBound]
-            depth_func = self.glpipe.depthState.depthFunction
-            depth_clamp = self.glpipe.rasterizer.state.depthClamp
-            if self.glpipe.vertexProcessing.clipNegativeOneToOne:
-                ndc_bounds = [-1.0, 1.0]
-        elif self.api == rd.GraphicsAPI.Vulkan:
-            depth_enabled = self.vkpipe.depthStencil.depthTestEnable
-            if self.vkpipe.depthStencil.depthBoundsEnable:
-                depth_bounds = [self.vkpipe.depthStencil.minDepthBounds,
-                                self.vkpipe.depthStencil.maxDepthBounds]
-            depth_func = self.vkpipe.depthStencil.depthFunction
-            depth_clamp = self.vkpipe.rasterizer.depthClampEnable
-        elif self.api == rd.GraphicsAPI.D3D11:
-            depth_enabled = self.d3d11pipe.outputMerger.depthStencilState.depthEnable
-            depth_func = self.d3d11pipe.outputMerger.depthStencilState.depthFunction
-            depth_clamp = not self.d3d11pipe.rasterizer.state.depthClip
-        elif self.api == rd.GraphicsAPI.D3D12:
-            depth_enabled = self.d3d12pipe.outputMerger.depthStencilState.depthEnable
-            if self.d3d12pipe.outputMerger.depthStencilState.depthBoundsEnable:
-                depth_bounds = [self.d3d12pipe.outputMerger.depthStencilState.minDepthBounds,
-                                self.d3d12pipe.outputMerger.depthStencilState.maxDepthBounds]
-            depth_func = self.d3d12pipe.outputMerger.depthStencilState.depthFunction
-            depth_clamp = not self.d3d12pipe.rasterizer.state.depthClip
+        depth_enabled, depth_func, depth_bounds, depth_clamp, ndc_bounds = self.depth_state
 
         # Check for state setups that will always fail
         if depth_func == rd.CompareFunction.Never:
@@ -1206,19 +1479,26 @@ class Analysis:
             raise AnalysisFinished
 
         # Calculate the min/max NDC bounds of the vertices in z
-        vert_ndc_z = list(filter(lambda _: math.isfinite(_), [vert[2] for vert in self.vert_ndc]))
-        vert_bounds = [min(vert_ndc_z), max(vert_ndc_z)]
+        vert_ndc_z = [z for _, _, z in self.vert_ndc if math.isfinite(z)]
+        vert_bounds = None
+        if len(vert_ndc_z) > 0:
+            vert_bounds = [min(vert_ndc_z), max(vert_ndc_z)]
 
-        self.analysis_steps.append(ResultStep(
-            msg='From the vertex output data I calculated the vertices lie within {:.4} and {:.4} in NDC z'
-                .format(vert_bounds[0], vert_bounds[1]),
-            pipe_stage=qrd.PipelineStage.Rasterizer))
+            self.analysis_steps.append(ResultStep(
+                msg='From the vertex output data I calculated the vertices lie within {:.4} and {:.4} in NDC z'
+                    .format(vert_bounds[0], vert_bounds[1]),
+                pipe_stage=qrd.PipelineStage.Rasterizer))
+        else:
+            self.analysis_steps.append(ResultStep(
+                msg='None of the vertex output data has a finite position in NDC z, so I couldn\'t check the vertices '
+                    'against the near/far planes or depth bounds.',
+                mesh_view=self.postvs_stage))
 
         state_name = 'Depth Clip' if rd.IsD3D(self.api) else 'Depth Clamp'
 
         # if depth clipping is enabled (aka depth clamping is disabled), this happens regardless of if
         # depth testing is enabled
-        if not depth_clamp:
+        if not depth_clamp and vert_bounds is not None:
             # If the largest vertex NDC z is lower than the NDC range, the whole draw is near-plane clipped
             if vert_bounds[1] < ndc_bounds[0]:
                 self.analysis_steps.append(ResultStep(
@@ -1244,7 +1524,7 @@ class Analysis:
                 self.analysis_steps.append(ResultStep(
                     msg='At least some of the vertices are on the passing side of the far plane',
                     mesh_view=self.postvs_stage))
-        else:
+        elif depth_clamp:
             self.analysis_steps.append(ResultStep(
                 msg='The current {} state means the near/far planes are ignored for clipping'.format(state_name)))
 
@@ -1252,7 +1532,7 @@ class Analysis:
         if not depth_enabled:
             self.analysis_steps.append(ResultStep(
                 msg='Depth test stage is disabled! Normally this means the depth test should always pass.\n\n'
-                    'Sorry I couldn\'t figure out the exact problem. Please check your {} '
+                    'Sorry I couldn\'t figure out the exact problem. Please check your depth '
                     'setup and report an issue so we can narrow this down in future.',
                 pipe_stage=qrd.PipelineStage.DepthTest))
 
@@ -1274,17 +1554,18 @@ class Analysis:
 
         # If the vertex NDC z range does not intersect the depth bounds range, and depth bounds test is
         # enabled, the draw fails the depth bounds test
-        if depth_bounds and (vert_bounds[0] > depth_bounds[1] or vert_bounds[1] < depth_bounds[0]):
+        if depth_bounds and vert_bounds is not None and (vert_bounds[0] > depth_bounds[1] or
+                                                         vert_bounds[1] < depth_bounds[0]):
             self.analysis_steps.append(ResultStep(
                 msg='All of the drawcall vertices are outside the depth bounds range ({} to {}), '
                     'which is enabled'.format(depth_bounds[0], depth_bounds[1]),
                 pipe_stage=qrd.PipelineStage.Rasterizer))
 
             raise AnalysisFinished
-        elif depth_bounds:
+        elif depth_bounds and vert_bounds is not None:
             self.analysis_steps.append(ResultStep(
                 msg='Some vertices are within the depth bounds range ({} to {})'
-                    .format(v.minDepth, v.maxDepth, depth_bounds[0], depth_bounds[1]),
+                    .format(depth_bounds[0], depth_bounds[1]),
                 mesh_view=self.postvs_stage))
 
         # Equal depth testing is often used but not equal is rare - flag it too
@@ -1321,15 +1602,17 @@ class Analysis:
 
             raise AnalysisFinished
 
-        # Get the last clear of the current depth buffer
-        usage = self.r.GetUsage(self.depth.resource)
-
-        # Filter for clears before this event
-        usage = [u for u in usage if u.eventId < self.eid and u.usage == rd.ResourceUsage.Clear]
+        # Get the last clear of the current depth buffer before this event. Usage is sorted by event so search backwards
+        # and stop at the first clear
+        clear_eid = 0
+        for u in reversed(self.r.GetUsage(self.depth.resource)):
+            if u.eventId < self.eid and u.usage == rd.ResourceUsage.Clear:
+                clear_eid = u.eventId
+                break
 
         # If there's a prior clear
-        if len(usage) > 0:
-            clear_eid = usage[-1].eventId
+        if clear_eid > 0:
+            depth_name = str(self.depth.resource)
 
             self.r.SetFrameEvent(clear_eid, True)
 
@@ -1338,37 +1621,39 @@ class Analysis:
                 tmp_glpipe = self.r.GetGLPipelineState()
                 s = tmp_glpipe.rasterizer.scissors[0]
                 if s.enabled:
-                    v = self.pipe.GetViewport(0)
+                    # Read the rects out once, the checks below use each value several times
+                    sx, sy, sw, sh = s.x, s.y, s.width, s.height
+                    v = self.viewport
+                    vx, vy = v.x, v.y
 
-                    s_right = s.x + s.width
-                    s_bottom = s.y + s.height
-                    v_right = v.x + v.width
-                    v_bottom = v.y + v.height
+                    s_right = sx + sw
+                    s_bottom = sy + sh
+                    v_right = vx + v.width
+                    v_bottom = vy + v.height
 
                     # if the scissor is empty or outside the size of the target that's certainly not intentional.
-                    if s.width == 0 or s.height == 0:
+                    if sw == 0 or sh == 0:
                         self.analysis_steps.append(ResultStep(
                             msg='The last depth-stencil clear of {} at {} had scissor enabled, but the scissor rect '
                                 '{},{} to {},{} is empty so nothing will get cleared.'
-                            .format(str(self.depth.resource), clear_eid, s.x, s.y, s_right, s_bottom),
+                            .format(depth_name, clear_eid, sx, sy, s_right, s_bottom),
                             pipe_stage=qrd.PipelineStage.ViewportsScissors))
 
-                    if s.x >= self.target_descs[-1].width or s.y >= self.target_descs[-1].height:
+                    if sx >= self.target_descs[-1].width or sy >= self.target_descs[-1].height:
                         self.analysis_steps.append(ResultStep(
                             msg='The last depth-stencil clear of {} at {} had scissor enabled, but the scissor rect '
                                 '{},{} to {},{} doesn\'t cover the depth-stencil target so it won\'t get cleared.'
-                            .format(str(self.depth.resource), clear_eid, s.x, s.y, s_right, s_bottom),
+                            .format(depth_name, clear_eid, sx, sy, s_right, s_bottom),
                             pipe_stage=qrd.PipelineStage.ViewportsScissors))
 
                     # if the clear's scissor doesn't overlap the viewport at the time of the draw,
                     # warn the user
-                    elif v.x < s.x or v.y < s.y or v.x + v_right or v_bottom > s_bottom:
+                    elif vx < sx or vy < sy or v_right > s_right or v_bottom > s_bottom:
                         self.analysis_steps.append(ResultStep(
                             msg='The last depth-stencil clear of {} at {} had scissor enabled, but the scissor rect '
                                 '{},{} to {},{} is smaller than the current viewport {},{} to {},{}. '
                                 'This may mean not every pixel was properly cleared.'
-                            .format(str(self.depth.resource), clear_eid, s.x, s.y, s_right, s_bottom, v.x, v.y,
-                                    v_right, v_bottom),
+                            .format(depth_name, clear_eid, sx, sy, s_right, s_bottom, vx, vy, v_right, v_bottom),
                             pipe_stage=qrd.PipelineStage.ViewportsScissors))
 
             # If this was a clear then we expect the depth value to be uniform, so pick the pixel to
@@ -1376,56 +1661,47 @@ class Analysis:
             clear_color = self.r.PickPixel(self.depth.resource, 0, 0,
                                            rd.Subresource(self.depth.firstMip, self.depth.firstSlice, 0),
                                            self.depth.format.compType)
+            clear_depth = clear_color.floatValue[0]
 
             self.r.SetFrameEvent(self.eid, True)
 
             if depth_func is not None:
-                if clear_eid > 0 and (
-                        clear_color.floatValue[0] == 1.0 and depth_func == rd.CompareFunction.Greater) or (
-                        clear_color.floatValue[0] == 0.0 and depth_func == rd.CompareFunction.Less):
+                func_name = str(depth_func).split('.')[-1]
+
+                if (clear_depth, depth_func) in impossible_depth_clears:
                     self.analysis_steps.append(ResultStep(
                         msg='The last depth clear of {} at @{} cleared depth to {:.4}, but the depth comparison '
-                            'function is {} which is impossible to pass.'.format(str(self.depth.resource),
-                                                                                 clear_eid,
-                                                                                 clear_color.floatValue[0],
-                                                                                 str(depth_func).split('.')[-1]),
+                            'function is {} which is impossible to pass.'
+                            .format(depth_name, clear_eid, clear_depth, func_name),
                         pipe_stage=qrd.PipelineStage.DepthTest))
 
                     raise AnalysisFinished
 
-                v = self.pipe.GetViewport(0)
+                v = self.viewport
 
-                if clear_eid > 0 and ((clear_color.floatValue[0] >= max(v.minDepth, v.maxDepth) and
-                                       depth_func == rd.CompareFunction.Greater) or
-                                      (clear_color.floatValue[0] <= min(v.minDepth, v.maxDepth) and
-                                       depth_func == rd.CompareFunction.Less) or
-                                      (clear_color.floatValue[0] > min(v.minDepth, v.maxDepth) and
-                                       depth_func == rd.CompareFunction.GreaterEqual) or
-                                      (clear_color.floatValue[0] < min(v.minDepth, v.maxDepth) and
-                                       depth_func == rd.CompareFunction.LessEqual)):
+                if ((clear_depth >= max(v.minDepth, v.maxDepth) and depth_func == rd.CompareFunction.Greater) or
+                        (clear_depth <= min(v.minDepth, v.maxDepth) and depth_func == rd.CompareFunction.Less) or
+                        (clear_depth > min(v.minDepth, v.maxDepth) and depth_func == rd.CompareFunction.GreaterEqual) or
+                        (clear_depth < min(v.minDepth, v.maxDepth) and depth_func == rd.CompareFunction.LessEqual)):
                     self.analysis_steps.append(ResultStep(
                         msg='The last depth clear of {} at @{} cleared depth to {:.4}, but the viewport '
                             'min/max bounds ({:.4} to {:.4}) mean this draw can\'t compare {}.'
-                            .format(str(self.depth.resource), clear_eid, clear_color.floatValue[0], v.minDepth,
-                                    v.maxDepth, str(depth_func).split('.')[-1]),
+                            .format(depth_name, clear_eid, clear_depth, v.minDepth, v.maxDepth, func_name),
                         pipe_stage=qrd.PipelineStage.DepthTest))
 
                     raise AnalysisFinished
 
                 # This isn't necessarily an error but is unusual - flag it
-                if clear_eid > 0 and (
-                        clear_color.floatValue[0] == 1.0 and depth_func == rd.CompareFunction.GreaterEqual) or (
-                        clear_color.floatValue[0] == 0.0 and depth_func == rd.CompareFunction.LessEqual):
+                if (clear_depth, depth_func) in unlikely_depth_clears:
                     self.analysis_steps.append(ResultStep(
                         msg='The last depth clear of {} at EID {} cleared depth to {}, but the depth comparison '
                             'function is {} which is highly unlikely to pass. This is worth checking'
-                        .format(str(self.depth.resource), clear_eid, clear_color.floatValue[0],
-                                str(depth_func).split('.')[-1]),
+                        .format(depth_name, clear_eid, clear_depth, func_name),
                         pipe_stage=qrd.PipelineStage.DepthTest))
                 else:
                     self.analysis_steps.append(ResultStep(
                         msg='The last depth clear of {} at @{} cleared depth to {}, which is reasonable.'
-                            .format(str(self.depth.resource), clear_eid, clear_color.floatValue[0])))
+                            .format(depth_name, clear_eid, clear_depth)))
 
         # If there's no depth/stencil clear found at all, that's a red flag
         else:
@@ -1437,25 +1713,14 @@ class Analysis:
         # history results to confirm or guide the user
         if self.api_properties.pixelHistory:
             self.tex_display.overlay = rd.DebugOverlay.Drawcall
-            self.out.SetTextureDisplay(self.tex_display)
-            overlay = self.out.GetDebugOverlayTexID()
+            out = self.get_output()
+            out.SetTextureDisplay(self.tex_display)
+            overlay = out.GetDebugOverlayTexID()
 
             sub = rd.Subresource(self.tex_display.subresource.mip, 0, 0)
 
-            drawcall_overlay_data = self.r.GetTextureData(overlay, sub)
-
-            dim = self.out.GetDimensions()
-
-            # Scan for a pixel that's covered
-            covered = None
-            for y in range(dim[1]):
-                for x in range(dim[0]):
-                    pixel_data = struct.unpack_from('4H', drawcall_overlay_data, (y * dim[0] + x) * 8)
-                    if pixel_data[0] != 0:
-                        covered = (x, y)
-                        break
-                if covered is not None:
-                    break
+            # Find any pixel that's covered
+            covered = self.find_covered_pixel(overlay, sub)
 
             if covered:
                 sub = rd.Subresource(self.targets[-1].firstMip, self.targets[-1].firstSlice)
@@ -1468,26 +1733,24 @@ class Analysis:
                             'I didn\'t get valid results!\n\n '
                             'This is a bug, please report it so it can be investigated.'.format(covered)))
                 else:
-                    this_draw = [h for h in history if h.eventId == self.eid]
-                    pre_draw_val = this_draw[0].preMod.depth if depth_func is not None else this_draw[0].preMod.stencil
+                    # History is sorted by event, so this draw's fragments are all at the end. Walk back to find
+                    # the first one, then only search the events before it.
+                    first_frag = len(history) - 1
+                    while first_frag > 0 and history[first_frag - 1].eventId == self.eid:
+                        first_frag -= 1
+                    num_frags = len(history) - first_frag
+
+                    # The modification members are named the same as the value we're checking
+                    get_val = operator.attrgetter(val_name)
+                    pre_draw_val = get_val(history[first_frag].preMod)
                     last_draw_eid = 0
-                    for h in reversed(history):
-                        # Skip this draw itself
-                        if h.eventId == self.eid:
-                            continue
-
-                        # Skip any failed events
-                        if not h.Passed():
-                            continue
-
-                        if depth_func is not None:
-                            if h.preMod.depth != pre_draw_val and h.postMod.depth == pre_draw_val:
-                                last_draw_eid = h.eventId
-                                break
-                        else:
-                            if h.preMod.stencil != pre_draw_val and h.postMod.stencil == pre_draw_val:
-                                last_draw_eid = h.eventId
-                                break
+                    for i in range(first_frag - 1, -1, -1):
+                        h = history[i]
+
+                        # Skip any failed events, otherwise look for the event that wrote the value
+                        if h.Passed() and get_val(h.preMod) != pre_draw_val and get_val(h.postMod) == pre_draw_val:
+                            last_draw_eid = h.eventId
+                            break
 
                     history_package = PixelHistoryData()
                     history_package.x = covered[0]
@@ -1506,14 +1769,14 @@ class Analysis:
                             msg='Pixel history on {} showed that {} fragments were outputted but their {} '
                                 'values all failed against the {} before the draw of {:.4}.\n\n '
                                 'The draw which outputted that depth value is at @{}.'
-                            .format(covered, len(this_draw), val_name, val_name, pre_draw_val, last_draw_eid),
+                            .format(covered, num_frags, val_name, val_name, pre_draw_val, last_draw_eid),
                             pixel_history=history_package))
                     else:
                         self.analysis_steps.append(ResultStep(
                             msg='Pixel history on {} showed that {} fragments outputted but their {} '
                                 'values all failed against the {} before the draw of {:.4}.\n\n '
                                 'No previous draw was detected that wrote that {} value.'
-                            .format(covered, len(this_draw), val_name, val_name, pre_draw_val, val_name),
+                            .format(covered, num_frags, val_name, val_name, pre_draw_val, val_name),
                             pixel_history=history_package))
             else:
                 self.analysis_steps.append(ResultStep(
@@ -1534,31 +1797,25 @@ class Analysis:
             msg='The stencil test overlay shows red, so the draw is completely failing a stencil test.',
             tex_display=self.tex_display))
 
+        stencil_enabled, front, back = self.stencil_state
+
+        if not stencil_enabled:
+            self.analysis_steps.append(ResultStep(
+                msg='Stencil test stage is disabled! Normally this means the stencil test should always '
+                    'pass.\n\n'
+                    'Sorry I couldn\'t figure out the exact problem. Please check your stencil '
+                    'setup and report an issue so we can narrow this down in future.',
+                pipe_stage=qrd.PipelineStage.StencilTest))
+
+            return
+
         # Get the cull mode. If culling is enabled we know which stencil state is in use and can narrow our analysis,
         # if culling is disabled then unfortunately we can't automatically narrow down which side is used.
-        cull_mode = rd.CullMode.NoCull
-        stencil_enabled = False
-        front = back = rd.StencilFace()
-        if self.api == rd.GraphicsAPI.OpenGL:
-            cull_mode = self.glpipe.rasterizer.state.cullMode
-            stencil_enabled = self.glpipe.stencilState.stencilEnable
-            front = self.glpipe.stencilState.frontFace
-            back = self.glpipe.stencilState.backFace
-        elif self.api == rd.GraphicsAPI.Vulkan:
-            cull_mode = self.vkpipe.rasterizer.cullMode
-            stencil_enabled = self.vkpipe.depthStencil.stencilTestEnable
-            front = self.vkpipe.depthStencil.frontFace
-            back = self.vkpipe.depthStencil.backFace
-        elif self.api == rd.GraphicsAPI.D3D11:
-            cull_mode = self.d3d11pipe.rasterizer.state.cullMode
-            stencil_enabled = self.d3d11pipe.outputMerger.depthStencilState.stencilEnable
-            front = self.d3d11pipe.outputMerger.depthStencilState.frontFace
-            back = self.d3d11pipe.outputMerger.depthStencilState.backFace
-        elif self.api == rd.GraphicsAPI.D3D12:
-            cull_mode = self.d3d12pipe.rasterizer.state.cullMode
-            stencil_enabled = self.d3d12pipe.outputMerger.depthStencilState.stencilEnable
-            front = self.d3d12pipe.outputMerger.depthStencilState.frontFace
-            back = self.d3d12pipe.outputMerger.depthStencilState.backFace
+        cull_mode = self.cull_state.cull_mode
+
+        # Copy out the face state the checks use, so each check reads plain values instead of going through the bindings
+        front = StencilFaceState(front.function, front.reference, front.compareMask)
+        back = StencilFaceState(back.function, back.reference, back.compareMask)
 
         # To simplify code, we're going to check if both faces are the same anyway so if one side is being culled we
         # just pretend that face has the same state as the other (which isn't culled)
@@ -1567,16 +1824,6 @@ class Analysis:
         elif cull_mode == rd.CullMode.Back:
             back = front
 
-        if not stencil_enabled:
-            self.analysis_steps.append(ResultStep(
-                msg='Depth test stage is disabled! Normally this means the depth test should always '
-                    'pass.\n\n'
-                    'Sorry I couldn\'t figure out the exact problem. Please check your {} '
-                    'setup and report an issue so we can narrow this down in future.',
-                pipe_stage=qrd.PipelineStage.DepthTest))
-
-            raise AnalysisFinished
-
         # Each of these checks below will check for two cases: first that the states are the same between front and
         # back, meaning EITHER that both were the same in the application so we don't need to know whether front or
         # back faces are in the draw, OR that one face is being culled so after we've eliminated a backface culling
@@ -1588,88 +1835,90 @@ class Analysis:
         # we can alert the users about it. This potentially has false positives if e.g. someone doesn't set backface
         # culling but also doesn't configure the backface stencil state.
 
-        def check_faces(msg: str, check: Callable[[rd.StencilFace], None]):
-            checks = check(front), check(back)
+        # When both faces have the same state, e.g. because one is culled, each check only needs to look at one of them
+        faces_equal = front == back
 
-            if all(checks):
-                self.analysis_steps.append(ResultStep(msg=msg.format(test='test', s=front),
-                                                      pipe_stage=qrd.PipelineStage.StencilTest))
+        for msg, conclusive, checks in stencil_face_checks:
+            front_matches = stencil_face_matches(front, checks)
+            back_matches = front_matches if faces_equal else stencil_face_matches(back, checks)
 
-                raise AnalysisFinished
-            elif checks[0]:
-                msg += ' If your draw relies on back faces then this could be the problem.'
-                self.analysis_steps.append(ResultStep(msg=msg.format(test='back face test', s=front),
-                                                      pipe_stage=qrd.PipelineStage.StencilTest))
-            elif checks[1]:
-                msg += ' If your draw relies on front faces then this could be the problem.'
-                self.analysis_steps.append(ResultStep(msg=msg.format(test='front face test', s=back),
+            if front_matches and back_matches:
+                self.analysis_steps.append(ResultStep(msg=msg.format(test='test', s=front),
                                                       pipe_stage=qrd.PipelineStage.StencilTest))
 
-        # Check simple cases that can't ever be true
-        check_faces('The stencil {test} is set to Never, meaning it always fails.',
-                    lambda x: x.function == rd.CompareFunction.Never)
-        check_faces('The stencil {test} is set to {s.function} than {s.reference}, which is impossible.',
-                    lambda x: (x.function == rd.CompareFunction.Less and x.reference == 0) or (
-                            x.function == rd.CompareFunction.Greater and x.reference == 255))
-        check_faces('The stencil {test} is set to {s.function} than {s.reference}, which is impossible.',
-                    lambda x: (x.function == rd.CompareFunction.LessEqual and x.reference < 0) or (
-                            x.function == rd.CompareFunction.GreaterEqual and x.reference > 255))
-
-        # compareMask being 0 is almost certainly a problem, but we can't *prove* it except in certain circumstances.
-        # e.g. having a compareMask of 0 and a reference of 0 would pass, or less than a non-zero reference.
-        # Fortunately, most of the cases we can prove will catch common errors. At least errors that cause a draw to
-        # not show up.
-
-        # if the compareMask is set such that the reference value can never be achieved, that's a guaranteed failure
-        check_faces(
-            'The stencil {test} is set to compare equal to {s.reference}, but the compare mask is {s.compareMask:x} '
-            'meaning it never can.',
-            lambda x: x.function == rd.CompareFunction.Equal and (
-                        (x.compareMask & x.reference) != x.reference) and x.reference != 0)
-
-        # The compareMask is the largest value that can be read, if the test is such that only larger values would pass,
-        # that's also broken.
-        check_faces(
-            'The stencil {test} is set to compare greater than {s.reference}, but the compare mask is '
-            '{s.compareMask:x} meaning it never can.',
-            lambda x: x.function == rd.CompareFunction.Greater and x.compareMask <= x.reference)
-        check_faces(
-            'The stencil {test} is set to compare greater than or equal to {s.reference}, but the compare mask is '
-            '{s.compareMask:x} meaning it never can.',
-            lambda x: x.function == rd.CompareFunction.GreaterEqual and x.compareMask < x.reference)
-
-        # Equal stencil testing is often used but not equal is rare - flag it too
-        try:
-            check_faces('The stencil {test} is set to Not Equal, which is not a problem but is unusual.',
-                        lambda x: x.function == rd.CompareFunction.Never)
-        except AnalysisFinished:
-            # we're not actually finished even if both faces were not equal!
-            pass
+                # The caller finishes the analysis once we return, so there's no need to raise here
+                if conclusive:
+                    return
+            elif front_matches:
+                self.analysis_steps.append(ResultStep(
+                    msg=(msg + front_face_hint).format(test='front face test', s=front),
+                    pipe_stage=qrd.PipelineStage.StencilTest))
+            elif back_matches:
+                self.analysis_steps.append(ResultStep(
+                    msg=(msg + back_face_hint).format(test='back face test', s=back),
+                    pipe_stage=qrd.PipelineStage.StencilTest))
 
         self.check_previous_depth_stencil(None)
 
     def get_steps(self):
         return self.analysis_steps
 
+    def get_output(self):
+        if self.out is None:
+            self.out = self.r.CreateOutput(rd.CreateHeadlessWindowingData(self.out_dim[0], self.out_dim[1]),
+                                           rd.ReplayOutputType.Texture)
+        return self.out
+
     def get_tex(self, resid: rd.ResourceId):
-        for t in self.textures:
-            if t.resourceId == resid:
-                return t
-        return None
+        return self.tex_lookup.get(resid)
 
     def get_buf(self, resid: rd.ResourceId):
-        for b in self.buffers:
-            if b.resourceId == resid:
-                return b
-        return None
+        return self.buf_lookup.get(resid)
+
+
+# Results of recently analysed draws by EID, most recently used last. The results only depend on the capture so this
+# must be cleared whenever a capture is loaded or closed. Only accessed on the UI thread.
+analysis_cache = OrderedDict()
+analysis_cache_size = 32
+
+
+def clear_analysis_cache():
+    analysis_cache.clear()
+
+
+# Editing a shader replaces it in the replay without reloading the capture, which can change the result for any draw
+def any_resource_replaced(ctx: qrd.CaptureContext):
+    return any(ctx.IsResourceReplaced(res.resourceId) for res in ctx.GetResources())
 
 
 def analyse_draw(ctx: qrd.CaptureContext, eid: int, finished_callback):
+    mqt = ctx.Extensions().GetMiniQtHelper()
+
+    # Cached results are only valid for the unmodified capture, so while anything is replaced always re-run the analysis
+    # and don't cache what it finds. Once the replacements are removed the earlier results are valid again.
+    cacheable = not any_resource_replaced(ctx)
+
+    # If we've analysed this draw recently, skip the replay entirely. Still invoke the callback asynchronously so the
+    # caller sees the same behaviour either way.
+    if cacheable and eid in analysis_cache:
+        analysis_cache.move_to_end(eid)
+        steps = analysis_cache[eid]
+        mqt.InvokeOntoUIThread(lambda: finished_callback(steps))
+        return
+
     # define a local function that wraps the detail of needing to invoke back/forth onto replay thread
     def _replay_callback(r: rd.ReplayController):
         analysis = Analysis(ctx, eid, r)
+        steps = analysis.get_steps()
+
+        def finish():
+            if cacheable:
+                analysis_cache[eid] = steps
+                if len(analysis_cache) > analysis_cache_size:
+                    analysis_cache.popitem(last=False)
+            finished_callback(steps)
 
-        # Invoke back onto the UI thread to display the results
-        ctx.Extensions().GetMiniQtHelper().InvokeOntoUIThread(lambda: finished_callback(analysis.get_steps()))
+        # Invoke back onto the UI thread to cache and display the results
+        mqt.InvokeOntoUIThread(finish)
 
     ctx.Replay().AsyncInvoke('where_is_my_draw', _replay_callback)
@@ -107,6 +107,7 @@ class Window(qrd.CaptureViewer):
 
     def OnCaptureLoaded(self):
         self.reset()
+        analyse.clear_analysis_cache()
 
         tex_data: rd.WindowingData = mqt.GetWidgetWindowingData(self.texOutWidget)
         mesh_data: rd.WindowingData = mqt.GetWidgetWindowingData(self.meshOutWidget)
@@ -124,6 +125,7 @@ class Window(qrd.CaptureViewer):
 
     def OnCaptureClosed(self):
         self.reset()
+        analyse.clear_analysis_cache()
 
     def reset(self):
         mqt.SetWidgetText(self.analyseButton, "Analyse draw")